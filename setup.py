@@ -31,9 +31,8 @@ setup(
     },
     include_package_data=False,
     install_requires=requirements,
+    python_requires='>=3.8',
     classifiers=['Environment :: Console',
-                 'Programming Language :: Python :: 3.6',
-                 'Programming Language :: Python :: 3.7',
                  'Programming Language :: Python :: 3.8',
                  'Programming Language :: Python :: 3.9']
 )
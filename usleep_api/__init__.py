@@ -1,2 +1,9 @@
 from .version import __version__
-from .usleep_api import USleepAPI
+
+
+def __getattr__(name):
+    # Import USleepAPI (and thereby requests) lazily, e.g. so that 'usleep-api --help' does not pay for it
+    if name == "USleepAPI":
+        from .usleep_api import USleepAPI
+        return USleepAPI
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
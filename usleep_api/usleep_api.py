@@ -3,29 +3,102 @@ logger = logging.getLogger(__name__)
 
 import os
 import time
+import random
 import requests
-import json
-from pprint import pformat
-from itertools import product
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt import MultipartEncoder
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from json import JSONDecodeError
-from usleep_api.utils import random_hex_string, temp_anonymized_edf
+try:
+    # Optional, faster JSON decoding. orjson.JSONDecodeError subclasses json.JSONDecodeError.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+from usleep_api.utils import random_hex_string, AnonymizedEDFReader
+
+# Number of seconds to cache server responses which rarely change (model names, configuration options)
+CACHE_TTL_SEC = 60
+
+# HTTP methods which may be passed to USleepAPI._request
+SUPPORTED_METHODS = frozenset(("GET", "POST", "DELETE"))
+
+# Lower-cased prediction status labels for which the prediction is no longer running
+FINISHED_STATUS_LABELS = frozenset(("completed", "failed", "error"))
+
+# Number of seconds a successful token validation is trusted before the token is validated again
+TOKEN_VALIDATION_TTL_SEC = 300
 
 
 class USleepAPI:
-    def __init__(self, api_token, session_name="default", validate_token=True, url="https://sleep.ai.ku.dk:443"):
+    # Maps (url, api_token) to time.monotonic() of the latest successful validation, shared by all instances
+    _validated_tokens = {}
+
+    def __init__(self, api_token, session_name="default", validate_token=True, url="https://sleep.ai.ku.dk:443",
+                 _requests_session=None):
+        """
+        :param api_token: U-Sleep API token, see https://sleep.ai.ku.dk.
+        :param session_name: Name of the server-side session to operate on.
+        :param validate_token: Ping the server to validate the token on initialization.
+        :param url: URL of the U-Sleep webserver.
+        :param _requests_session: Internal, used by 'new_session' only. An already configured requests session
+                                  (with HTTPAdapter and Authorization header for the same token) to share.
+        """
         self.url = url.rstrip("/")
-        self.requests_session = requests.sessions.Session()
         self.session_name = session_name
+        self._session_base = f"/api/v1/sleep_stager/{session_name}"
         self.api_token = api_token
+        # Mutable caches for rarely changing server responses, see _cached
+        self._model_names_cache = {'value': None, 'fetched_at': 0.0}
+        self._configuration_options_cache = {'value': None, 'fetched_at': 0.0}
+        if _requests_session is not None:
+            # Reuse the parent's (already configured) session and its pool of keep-alive connections
+            self.requests_session = _requests_session
+        else:
+            self.requests_session = requests.sessions.Session()
+            self._mount_http_adapter(self.requests_session)
+            if self.api_token:
+                self.requests_session.headers['Authorization'] = f"Bearer {self.api_token}"
         if validate_token:
             self.validate_token()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """ Close the pooled connections of the (possibly shared) requests session """
+        self.requests_session.close()
+
+    @staticmethod
+    def _mount_http_adapter(requests_session):
+        """
+        Mount an HTTPAdapter on the session which keeps a larger pool of keep-alive connections to the server
+        and retries idempotent requests on connection errors and transient gateway errors.
+        POST requests are not retried as they may not be safe to repeat (e.g., starting a prediction).
+        """
+        adapter = HTTPAdapter(pool_connections=4,
+                              pool_maxsize=32,
+                              max_retries=Retry(total=3,
+                                                backoff_factor=0.3,
+                                                status_forcelist=(502, 503, 504),
+                                                allowed_methods=frozenset(["GET", "DELETE"]),
+                                                raise_on_status=False))
+        requests_session.mount("https://", adapter)
+        requests_session.mount("http://", adapter)
+
     def new_session(self, session_name):
-        return USleepAPI(api_token=self.api_token,
-                         url=self.url,
-                         session_name=session_name,
-                         validate_token=False)
+        session = USleepAPI(api_token=self.api_token,
+                            url=self.url,
+                            session_name=session_name,
+                            validate_token=False,
+                            _requests_session=self.requests_session)
+        # Model names are not session specific, share the (mutable) cache with the new session
+        session._model_names_cache = self._model_names_cache
+        return session
 
     @contextmanager
     def new_session_context(self, session_name):
@@ -36,10 +109,17 @@ class USleepAPI:
             session.delete_session()
 
     def validate_token(self):
+        key = (self.url, self.api_token)
+        validated_at = self._validated_tokens.get(key)
+        if validated_at is not None and time.monotonic() - validated_at < TOKEN_VALIDATION_TTL_SEC:
+            logger.info("Auth token was recently validated, skipping validation.")
+            return
         logger.info("Validating auth token...")
         response = self.get("/api/v1/info/ping")
         if response.status_code != 200:
+            self._validated_tokens.pop(key, None)
             raise ConnectionRefusedError("Invalid authentication token specified.")
+        self._validated_tokens[key] = time.monotonic()
 
     def _add_token_to_headers(self, headers=None):
         headers = headers or {}
@@ -48,32 +128,27 @@ class USleepAPI:
 
     @staticmethod
     def _log_response(response, type_):
-        logger_method = logger.info if response.status_code in (200, 201) else logger.error
-        try:
-            content = "[JSON data] " + str(response.json())[:50] + " ..."
-        except json.JSONDecodeError:
-            content = response.content.decode('utf-8')
-        logger_method(f"Server response to {type_}: {content}")
+        level = logging.INFO if response.status_code in (200, 201) else logging.ERROR
+        if not logger.isEnabledFor(level):
+            return
+        if response.headers.get("Content-Type", "").startswith("application/json"):
+            # Only log the beginning of the raw JSON string, no need to decode it
+            content = "[JSON data] " + response.text[:50] + " ..."
+        else:
+            content = response.content[:200].decode('utf-8', errors='replace')
+        logger.log(level, "Server response to %s: %s", type_, content)
 
     def _request(self, endpoint, method, as_json=False, log_response=True, headers=None, **kwargs):
         uri = f"{self.url}/{endpoint.lstrip('/')}"
         method = method.upper()
-        if method == "GET":
-            request_method = self.requests_session.get
-        elif method == "POST":
-            request_method = self.requests_session.post
-        elif method == "DELETE":
-            request_method = self.requests_session.delete
-        else:
+        if method not in SUPPORTED_METHODS:
             raise ValueError(f"Method {method} is not supported.")
-        if self.api_token:
-            headers = self._add_token_to_headers(headers)
-        response = request_method(uri, headers=headers, **kwargs)
+        response = self.requests_session.request(method, uri, headers=headers, **kwargs)
         if log_response:
             self._log_response(response, type_=method)
         if as_json:
             try:
-                return response.json()
+                return json_loads(response.content)
             except JSONDecodeError as e:
                 raise ValueError("Could not convert response to JSON. "
                                  "The requested resource most likely does not exist. "
@@ -97,84 +172,167 @@ class USleepAPI:
     def get_config_variable(self, variable):
         return self.get(f"/api/v1/info/config/{variable}", as_json=True)
 
+    @staticmethod
+    def _cached(cache, fetch, ttl_sec=CACHE_TTL_SEC):
+        """
+        Return the value stored in the 'cache' dict if it is younger than 'ttl_sec' seconds.
+        Otherwise, call 'fetch', store and return its result.
+        """
+        if cache['value'] is not None and time.monotonic() - cache['fetched_at'] < ttl_sec:
+            return cache['value']
+        value = fetch()
+        cache.update(value=value, fetched_at=time.monotonic())
+        return value
+
     def get_model_names(self):
-        return self.get("/api/v1/info/model_names", as_json=True)['models']
+        return self._cached(self._model_names_cache,
+                            lambda: self.get("/api/v1/info/model_names", as_json=True)['models'])
 
     def set_model(self, model_str):
-        logger.info(f"Setting model '{model_str}'")
+        logger.info("Setting model '%s'", model_str)
         model_names = self.get_model_names()
         if model_str not in model_names:
             err = "Invalid model, must be in {}".format(model_names)
             logger.error(err)
             raise ValueError(err)
-        self.post(f"/api/v1/sleep_stager/{self.session_name}/set_model", data={'model': model_str})
+        self.post(f"{self._session_base}/set_model", data={'model': model_str})
+        # Configuration options depend on the model
+        self._configuration_options_cache['value'] = None
 
     def get_file_info(self):
-        return self.get(f"/api/v1/sleep_stager/{self.session_name}/file", as_json=True)
+        return self.get(f"{self._session_base}/file", as_json=True)
 
     def upload_file(self, file_path, anonymize_before_upload=False):
-        logger.info(f"Uploading file at path {file_path}. Please wait.")
-        with temp_anonymized_edf(file_path) if anonymize_before_upload else open(file_path, "rb") as in_f:
-            return self.post(f"/api/v1/sleep_stager/{self.session_name}/file", files={'PSG': in_f})
+        logger.info("Uploading file at path %s. Please wait.", file_path)
+        with AnonymizedEDFReader(file_path) if anonymize_before_upload else open(file_path, "rb") as in_f:
+            # Do not send the original file name (which may identify the patient) with anonymized files
+            file_name = f"{random_hex_string()}.edf" if anonymize_before_upload else os.path.basename(file_path)
+            # Stream the multipart body from disk instead of encoding the whole file in memory
+            encoder = MultipartEncoder(fields={'PSG': (file_name, in_f, 'application/octet-stream')})
+            return self.post(f"{self._session_base}/file",
+                             data=encoder,
+                             headers={'Content-Type': encoder.content_type})
 
     def delete_file(self):
-        return self.delete(f"/api/v1/sleep_stager/{self.session_name}/file")
+        return self.delete(f"{self._session_base}/file")
 
     def get_configuration_options(self):
         logger.info("Getting configuration")
-        return self.get(f"/api/v1/sleep_stager/{self.session_name}/configuration_options", as_json=True)
+        return self._cached(self._configuration_options_cache,
+                            lambda: self.get(f"{self._session_base}/configuration_options",
+                                             as_json=True))
 
     def get_status(self):
-        return self.get(f"/api/v1/sleep_stager/{self.session_name}/prediction_status", as_json=True)
+        return self.get(f"{self._session_base}/prediction_status", as_json=True)
 
     def get_hypnogram(self):
-        response = self.get(f"/api/v1/sleep_stager/{self.session_name}/hypnogram")
+        response = self.get(f"{self._session_base}/hypnogram")
         if response.status_code == 200:
-            response = response.json()
+            response = json_loads(response.content)
         return response
 
     def get_prediction_log(self):
-        return self.get(f'/api/v1/sleep_stager/{self.session_name}/prediction_log', as_json=True)['log']
+        return self.get(f'{self._session_base}/prediction_log', as_json=True)['log']
 
-    def stream_prediction_log(self, verbose=True):
+    def stream_prediction_log(self, verbose=True, min_delay_sec=0.25, max_delay_sec=10.0, max_failures=5):
+        """
+        Stream the prediction log until the server reports the prediction as finished.
+
+        The polling interval is reset to 'min_delay_sec' whenever new log output arrives and otherwise grows
+        geometrically towards 'max_delay_sec' while the log is idle. A +/-20% jitter is applied to each delay.
+        Failed polls (connection errors, timeouts or non-200 responses) are retried with exponential backoff
+        from 1 to 60 seconds.
+
+        :param verbose: Print new log output to stdout as it arrives.
+        :param min_delay_sec: Polling interval used while the log is actively updating.
+        :param max_delay_sec: Upper bound on the polling interval while the log is idle.
+        :param max_failures: Number of consecutive failed polls after which an error is raised.
+        :return: A tuple (success, log) where success is True if the prediction completed.
+        """
         full_log = []
+        state = {'interval': min_delay_sec}
+        endpoint = f"{self._session_base}/prediction_log_stream"
+
+        def poll():
+            """ Returns the decoded log stream response, retrying with exponential backoff on failures """
+            error_interval, failures = 1, 0
+            while True:
+                try:
+                    response = self.get(endpoint, log_response=False)
+                    if response.status_code == 200:
+                        return json_loads(response.content)
+                    error = ValueError(response.content)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    error = e
+                failures += 1
+                if failures >= max_failures:
+                    raise error
+                logger.warning("Failed to fetch prediction log (%i/%i): %s. Retrying in %i seconds.",
+                               failures, max_failures, error, error_interval)
+                time.sleep(error_interval)
+                error_interval = min(error_interval * 2, 60)
 
         def stream(delay_sec=0):
             """ Returns True if 'stream' should be called again, False otherwise """
             time.sleep(delay_sec)
-            response = self.get(f"/api/v1/sleep_stager/{self.session_name}/prediction_log_stream", log_response=False)
-            if response.status_code != 200:
-                raise ValueError(response.content)
-            response = response.json()
+            response = poll()
             log = response['log']
             if log:
                 if verbose:
                     print(log)
                 full_log.append(log)
+                state['interval'] = min_delay_sec
+            else:
+                state['interval'] = min(state['interval'] * 1.7, max_delay_sec)
             return not response['finished']
         continue_stream = stream()
         while continue_stream:
-            continue_stream = stream(delay_sec=2)
+            continue_stream = stream(delay_sec=state['interval'] * random.uniform(0.8, 1.2))
         full_log = "".join(full_log)
         return self.get_status()['label'].lower() == "completed", full_log
 
-    def wait_for_completion(self):
+    def wait_for_completion(self, min_delay_sec=0.25, max_delay_sec=10.0, timeout_sec=None):
+        """
+        Poll the (lightweight) prediction status until the prediction has finished without downloading the log.
+        The polling interval grows geometrically from 'min_delay_sec' to 'max_delay_sec' with +/-20% jitter.
+
+        The prediction status response has no explicit 'finished' flag (unlike the prediction log stream), so the
+        prediction is considered finished when its status label is one of FINISHED_STATUS_LABELS. A terminal label
+        not in FINISHED_STATUS_LABELS is not recognized and polling continues until 'timeout_sec' (if set).
+
+        :param timeout_sec: Optional maximum number of seconds to wait. Default is None (wait indefinitely).
+        :return: True if the prediction completed, False otherwise.
+        :raises TimeoutError: If the prediction has not finished within 'timeout_sec' seconds.
+        """
         logger.info("Waiting for prediction completion...")
-        self.stream_prediction_log(verbose=False)
-        return self.get_status()['label'].lower() == "completed"
+        deadline = None if timeout_sec is None else time.monotonic() + timeout_sec
+        delay_sec = min_delay_sec
+        while True:
+            label = self.get_status()['label'].lower()
+            if label in FINISHED_STATUS_LABELS:
+                return label == "completed"
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"Prediction did not finish within {timeout_sec} seconds "
+                                   f"(last status label: '{label}').")
+            sleep_sec = delay_sec * random.uniform(0.8, 1.2)
+            if deadline is not None:
+                sleep_sec = max(0.0, min(sleep_sec, deadline - time.monotonic()))
+            time.sleep(sleep_sec)
+            delay_sec = min(delay_sec * 1.7, max_delay_sec)
 
     def get_session_names(self):
         return self.get(f"/api/v1/sleep_stager/session_names", as_json=True)['session_names']
 
     def get_session_details(self):
-        return self.get(f"/api/v1/sleep_stager/{self.session_name}", as_json=True)
+        return self.get(self._session_base, as_json=True)
 
     def delete_session(self):
-        return self.delete(f"/api/v1/sleep_stager/{self.session_name}")
+        return self.delete(self._session_base)
 
-    def delete_all_sessions(self):
-        for session in self.get_session_names():
-            self.new_session(session).delete_session()
+    def delete_all_sessions(self, max_workers=16):
+        session_names = self.get_session_names()
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(session_names)))) as executor:
+            return list(executor.map(lambda session: self.new_session(session).delete_session(), session_names))
 
     def download_hypnogram(self, out_path, file_type='tsv', with_confidence_scores=False):
         file_type = file_type.strip(".")
@@ -184,16 +342,19 @@ class USleepAPI:
                              f"'{file_type}'. Must be 'npy'.")
         # Download file
         leading_name = 'hypnogram_' if not with_confidence_scores else 'hypnogram_raw_'
-        response = self.get(endpoint=f"/api/v1/sleep_stager/{self.session_name}/download/{leading_name}{file_type}",
-                            log_response=False)
-        if response.status_code == 200:
-            # Save file to disk
-            out_path = os.path.splitext(out_path)[0] + f".{file_type}"
-            logger.info(f"Saving file to {out_path}")
-            with open(out_path, "wb") as out_f:
-                out_f.write(response.content)
-        else:
-            raise ValueError(response.content.decode())
+        response = self.get(endpoint=f"{self._session_base}/download/{leading_name}{file_type}",
+                            log_response=False,
+                            stream=True)
+        with response:
+            if response.status_code == 200:
+                # Stream file to disk
+                out_path = os.path.splitext(out_path)[0] + f".{file_type}"
+                logger.info("Saving file to %s", out_path)
+                with open(out_path, "wb") as out_f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        out_f.write(chunk)
+            else:
+                raise ValueError(response.content.decode())
 
     def _infer_channel_groups(self):
         """
@@ -201,24 +362,34 @@ class USleepAPI:
 
         :return:
         """
-        file_info = self.get_file_info()
+        from itertools import product, islice
+        # The three requests are independent, fetch them concurrently over the pooled connections
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            file_info = executor.submit(self.get_file_info)
+            configuration_options = executor.submit(self.get_configuration_options)
+            max_groups = executor.submit(self.get_config_variable, "MAX_CHANNEL_COMBINATIONS")
+        file_info = file_info.result()
+        required_types = configuration_options.result()['required_channels']
+        max_groups = max_groups.result()['MAX_CHANNEL_COMBINATIONS']
         channels = file_info['channels']
         types = file_info['inferred_channel_types']
-        required_types = self.get_configuration_options()['required_channels']
         matching_channels = [[
             channel for channel, type in zip(channels, types) if type in required
         ] for required in required_types]
-        all_groups = list(product(*matching_channels))
-        max_groups = self.get_config_variable("MAX_CHANNEL_COMBINATIONS")['MAX_CHANNEL_COMBINATIONS']
-        groups = all_groups[:max_groups]
-        logger.info(f"Auto-inferring channel groups...\n"
-                    f"-- Channels in file:        {channels}\n"
-                    f"-- Inferred types:          {types}\n"
-                    f"-- Required types:          {required_types}\n"
-                    f"-- Matching channels:       {matching_channels}\n"
-                    f"-- Inferred groups:         (N={len(all_groups)}) {all_groups}\n"
-                    f"-- Max allowed groups:      {max_groups}\n"
-                    f"-- Final groups:            (N={len(all_groups)} {groups}")
+        # Only generate the combinations that are used, the full product may be very large
+        groups = list(islice(product(*matching_channels), max_groups))
+        n_all_groups = 1
+        for channels_of_type in matching_channels:
+            n_all_groups *= len(channels_of_type)
+        logger.info("Auto-inferring channel groups...\n"
+                    "-- Channels in file:        %s\n"
+                    "-- Inferred types:          %s\n"
+                    "-- Required types:          %s\n"
+                    "-- Matching channels:       %s\n"
+                    "-- Inferred groups:         (N=%i)\n"
+                    "-- Max allowed groups:      %i\n"
+                    "-- Final groups:            (N=%i) %s",
+                    channels, types, required_types, matching_channels, n_all_groups, max_groups, len(groups), groups)
         return groups
 
     def predict(self, data_per_prediction, channel_groups=None):
@@ -232,13 +403,10 @@ class USleepAPI:
         data = {'data_per_prediction': int(data_per_prediction)}
         if channel_groups is None:
             channel_groups = self._infer_channel_groups()
-        entry_count = 0
-        for group_idx, group in enumerate(channel_groups):
-            for channel in group:
-                data[f'channels-{entry_count}'] = channel
-                data[f'channel_group_idx-{entry_count}'] = group_idx
-                entry_count += 1
-        return self.post(f"/api/v1/sleep_stager/{self.session_name}/predict", data=data)
+        flat_channels = [(group_idx, channel) for group_idx, group in enumerate(channel_groups) for channel in group]
+        data.update({f'channels-{i}': channel for i, (_, channel) in enumerate(flat_channels)})
+        data.update({f'channel_group_idx-{i}': group_idx for i, (group_idx, _) in enumerate(flat_channels)})
+        return self.post(f"{self._session_base}/predict", data=data)
 
     def quick_predict(self,
                       input_file_path,
@@ -264,24 +432,31 @@ class USleepAPI:
         :param stream_log:
         :return:
         """
+        from pprint import pformat
         session_name = random_hex_string()
-        logger.info(f"Creating throw-away session '{session_name}'")
+        logger.info("Creating throw-away session '%s'", session_name)
         with self.new_session_context(session_name) as session:
             session.set_model(model)
             session.upload_file(input_file_path, anonymize_before_upload=anonymize_before_upload)
-            logger.info(f"The server has the following info the uploaded file:\n{pformat(session.get_file_info())}")
+            if logger.isEnabledFor(logging.INFO):
+                # Only fetch and format the file info if it is going to be logged
+                logger.info("The server has the following info the uploaded file:\n%s",
+                            pformat(session.get_file_info()))
             session.predict(data_per_prediction=data_per_prediction,
                             channel_groups=channel_groups)
             success, log = session.stream_prediction_log(stream_log)
             if success:
-                # Fetch hypnogram
-                hyp = session.get_hypnogram()
-                if output_file_path:
-                    # Download hypnogram file
-                    path, type_ = os.path.splitext(output_file_path)
-                    session.download_hypnogram(out_path=path,
-                                               file_type=type_,
-                                               with_confidence_scores=with_confidence_scores)
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    # Fetch hypnogram while (optionally) downloading the hypnogram file
+                    hyp = executor.submit(session.get_hypnogram)
+                    if output_file_path:
+                        path, type_ = os.path.splitext(output_file_path)
+                        download = executor.submit(session.download_hypnogram,
+                                                   out_path=path,
+                                                   file_type=type_,
+                                                   with_confidence_scores=with_confidence_scores)
+                        download.result()
+                    hyp = hyp.result()
             else:
                 logger.error("Prediction failed.")
                 hyp = None
@@ -289,3 +464,38 @@ class USleepAPI:
                 with open(log_file_path, "w") as out_f:
                     out_f.write(log)
             return hyp, log
+
+    def quick_predict_many(self,
+                           input_file_paths,
+                           output_file_paths=None,
+                           log_file_paths=None,
+                           max_workers=8,
+                           **kwargs):
+        """
+        Run 'quick_predict' on multiple files concurrently, each in its own throw-away session.
+
+        The time spent on a single prediction is dominated by network I/O and waiting for the server, so the
+        predictions are run in a pool of threads sharing this API object.
+
+        :param input_file_paths: List of paths to PSG files to score.
+        :param output_file_paths: Optional list of output hypnogram paths, one per input file.
+        :param log_file_paths: Optional list of prediction log paths, one per input file.
+        :param max_workers: Maximum number of predictions running at the same time.
+        :param kwargs: Other keyword arguments passed to 'quick_predict' for every file.
+        :return: A list of (hypnogram, log) tuples in the order of 'input_file_paths'.
+        """
+        input_file_paths = list(input_file_paths)
+        output_file_paths = output_file_paths or [None] * len(input_file_paths)
+        log_file_paths = log_file_paths or [None] * len(input_file_paths)
+        if not (len(input_file_paths) == len(output_file_paths) == len(log_file_paths)):
+            raise ValueError("The number of output file paths and log file paths must match the number of input "
+                             "file paths.")
+
+        def predict_one(paths):
+            input_file_path, output_file_path, log_file_path = paths
+            return self.quick_predict(input_file_path=input_file_path,
+                                      output_file_path=output_file_path,
+                                      log_file_path=log_file_path,
+                                      **kwargs)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(input_file_paths)))) as executor:
+            return list(executor.map(predict_one, zip(input_file_paths, output_file_paths, log_file_paths)))
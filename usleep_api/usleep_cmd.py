@@ -4,31 +4,36 @@ logger = logging.getLogger(__name__)
 import sys
 import os
 from getpass import getpass
+from functools import lru_cache
 from pathlib import Path
 from argparse import ArgumentParser
-from usleep_api import USleepAPI
 
+# Supported file extensions of input PSG files and output hypnogram files
+VALID_IN_SUFFIXES = frozenset((".edf",))
+VALID_OUT_SUFFIXES = frozenset((".tsv", ".txt", ".npy"))
 
+USAGE = ("U-Sleep command line interface to the U-Sleep Web API. May be used to perform sleep stage scoring of "
+         "EDF(+) files using the U-Sleep webserver at https://sleep.ai.ku.dk.\n\n"
+         "Authentication: An API access token must be created at https://sleep.ai.ku.dk. Store the token in an "
+         "environment variable of name specified by the '--api-token-env-name' flag (default 'USLEEP_API_TOKEN') "
+         "or pass the token to the --token flag (not recommended).\n\n"
+         "Basic usage:\n"
+         ">> usleep-api [input file path] [output file path]\n\n"
+         "Examples:\n"
+         ">> usleep-api ./my_psg.edf ./hypnogram.tsv\n"
+         ">> usleep-api ./my_psg.edf ./hypnogram.tsv\n"
+         ">> usleep-api ./my_psg.edf ./hypnogram.tsv -l prediction_log.txt\n"
+         ">> usleep-api ./my_psg.edf ./hypnogram.tsv --print-hypnogram\n"
+         ">> usleep-api ./my_psg.edf ./hypnogram.tsv --log-level=ERROR\n"
+         ">> usleep-api ./my_psg.edf ./hypnogram.tsv --anonymize-before-upload\n"
+         ">> usleep-api ./my_psg.edf ./hypnogram.tsv --channel-groups C3-A2++EOG C4-A1++EOG F3-A2++EOG\n"
+         ">> usleep-api ./my_psg.edf ./hypnogram.txt --data-per-prediction 128\n"
+         ">> usleep-api ./my_psg.edf ./hypnogram.npy --with-confidence-scores")
+
+
+@lru_cache(maxsize=1)
 def get_argparser():
-    parser = ArgumentParser(
-        usage="U-Sleep command line interface to the U-Sleep Web API. May be used to perform sleep stage scoring of "
-              "EDF(+) files using the U-Sleep webserver at https://sleep.ai.ku.dk.\n\n"
-              "Authentication: An API access token must be created at https://sleep.ai.ku.dk. Store the token in an "
-              "environment variable of name specified by the '--api-token-env-name' flag (default 'USLEEP_API_TOKEN') "
-              "or pass the token to the --token flag (not recommended).\n\n"
-              "Basic usage:\n"
-              ">> usleep-api [input file path] [output file path]\n\n"
-              "Examples:\n"
-              ">> usleep-api ./my_psg.edf ./hypnogram.tsv\n"
-              ">> usleep-api ./my_psg.edf ./hypnogram.tsv\n"
-              ">> usleep-api ./my_psg.edf ./hypnogram.tsv -l prediction_log.txt\n"
-              ">> usleep-api ./my_psg.edf ./hypnogram.tsv --print-hypnogram\n"
-              ">> usleep-api ./my_psg.edf ./hypnogram.tsv --log-level=ERROR\n"
-              ">> usleep-api ./my_psg.edf ./hypnogram.tsv --anonymize-before-upload\n"
-              ">> usleep-api ./my_psg.edf ./hypnogram.tsv --channel-groups C3-A2++EOG C4-A1++EOG F3-A2++EOG\n"
-              ">> usleep-api ./my_psg.edf ./hypnogram.txt --data-per-prediction 128\n"
-              ">> usleep-api ./my_psg.edf ./hypnogram.npy --with-confidence-scores"
-    )
+    parser = ArgumentParser(usage=USAGE)
     parser.add_argument("input file path", type=str, help="Path to input EDF(+) (.edf) file to score.")
     parser.add_argument("output file path", type=str, help="Path to output file, e.g., 'hypnogram.tsv'. "
                                                            "Extension must be one of [.tsv, .txt, .npy].")
@@ -47,7 +52,7 @@ def get_argparser():
                              "Without the flag an argmaxed [n_periods] array of integers.")
     parser.add_argument("--anonymize-before-upload", action="store_true",
                         help="Anonymize the input file before uploading to the server. "
-                             "This creates a temporary file and does not modify the original file. "
+                             "The file is anonymized while it is uploaded and the original file is not modified. "
                              "Note: The EDF file will be anonymized with respect to: Patient ID, sex, name and DOB "
                              "as well as equipment, admin, and technician codes, recording date and time. Events and "
                              "channel names are NOT anonymized. Default is False (upload file as-is).")
@@ -84,12 +89,17 @@ def init_logging(level):
     return logger
 
 
+@lru_cache(maxsize=None)
+def get_env_token(env_name):
+    return os.environ[env_name]
+
+
 def get_token(args):
     try:
-        token = args['token'] or os.environ[args['api_token_env_name']]
+        token = args['token'] or get_env_token(args['api_token_env_name'])
     except KeyError:
-        logger.warning(f"No token passed with --token flag and no environment variable "
-                       f"of name '{args['api_token_env_name']}' found.")
+        logger.warning("No token passed with --token flag and no environment variable of name '%s' found.",
+                       args['api_token_env_name'])
         token = getpass("\nMissing API token. Create an API token at https://sleep.ai.ku.dk and paste it here: ")
     return token
 
@@ -97,42 +107,48 @@ def get_token(args):
 def entry_func():
     args = vars(get_argparser().parse_args(sys.argv[1:]))
     logger = init_logging(args['log_level'])
-    logger.info(f"Running with args: {args}")
+    logger.info("Running with args: %s", args)
     in_path = Path(args['input file path']).absolute()
-    if not in_path.exists() or in_path.suffix != ".edf":
+    # Check the suffix first so that the file system is only hit (with a single stat call) for .edf paths
+    if in_path.suffix not in VALID_IN_SUFFIXES or not os.path.isfile(in_path):
         raise OSError(f"Input file at '{args['input file path']}' does not exist or is not a '.edf' file "
                       f"(currently only supported file type).")
     out_path = Path(args['output file path']).absolute()
-    if out_path.suffix not in (".tsv", ".txt", ".npy"):
-        raise ValueError(f"Out file path must have extension in ('.tsv', '.txt', '.npy'), got '{out_path.suffix}'")
-    if out_path.suffix != '.npy' and args['with_confidence_scores']:
+    out_suffix = out_path.suffix
+    if out_suffix not in VALID_OUT_SUFFIXES:
+        raise ValueError(f"Out file path must have extension in {tuple(sorted(VALID_OUT_SUFFIXES))}, "
+                         f"got '{out_suffix}'")
+    if out_suffix != '.npy' and args['with_confidence_scores']:
         raise ValueError(f"Cannot download hypnogram with confidence scores as file type "
-                         f"'{out_path.suffix}'. Must be 'npy'.")
+                         f"'{out_suffix}'. Must be 'npy'.")
     overwrite = args['overwrite_file']
-    if out_path.exists() and not overwrite:
+    if not overwrite and os.path.lexists(out_path):
         raise OSError(f"Output hypnogram file at '{out_path}' already exists and the --overwrite-file flag was not set.")
     if args['log_file_path']:
         log_file_path = Path(args['log_file_path']).absolute()
-        if log_file_path.exists() and not overwrite:
-            raise OSError(f"Output log file at '{out_path}' already exists and the --overwrite-file flag was not set.")
+        if not overwrite and os.path.lexists(log_file_path):
+            raise OSError(f"Output log file at '{log_file_path}' already exists and the --overwrite-file flag was "
+                          f"not set.")
     else:
         log_file_path = None
-    logger.info(f"Input file:          {in_path}")
-    logger.info(f"Output file:         {out_path}")
-    logger.info(f"Prediction log file: {log_file_path}")
-
-    api = USleepAPI(api_token=get_token(args))
-    hypnogram, log = api.quick_predict(
-        input_file_path=in_path,
-        output_file_path=out_path,
-        model=args['model'],
-        anonymize_before_upload=args['anonymize_before_upload'],
-        data_per_prediction=args['data_per_prediction'],
-        channel_groups=[c.split("++") for c in args['channel_groups']] if args['channel_groups'] else None,
-        with_confidence_scores=args['with_confidence_scores'],
-        stream_log=args['stream_log'],
-        log_file_path=log_file_path
-    )
+    logger.info("Input file:          %s", in_path)
+    logger.info("Output file:         %s", out_path)
+    logger.info("Prediction log file: %s", log_file_path)
+
+    # Imported here so that --help and invalid arguments do not pay for importing requests etc.
+    from usleep_api import USleepAPI
+    with USleepAPI(api_token=get_token(args)) as api:
+        hypnogram, log = api.quick_predict(
+            input_file_path=in_path,
+            output_file_path=out_path,
+            model=args['model'],
+            anonymize_before_upload=args['anonymize_before_upload'],
+            data_per_prediction=args['data_per_prediction'],
+            channel_groups=[c.split("++") for c in args['channel_groups']] if args['channel_groups'] else None,
+            with_confidence_scores=args['with_confidence_scores'],
+            stream_log=args['stream_log'],
+            log_file_path=log_file_path
+        )
     if args['print_hypnogram']:
         print(hypnogram)
 
@@ -1,34 +1,115 @@
 import logging
 logger = logging.getLogger(__name__)
-import random
+import os
+import shutil
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 
-
-def random_hex_string(length=12):
-    return "{:x}".format(random.randrange(16**length))
+# Anonymized EDF header fields written at byte offset 8: local patient identification (80 bytes), local recording
+# identification (80 bytes), start date (8 bytes) and start time (8 bytes) of the recording
+ANONYMIZED_EDF_HEADER_FIELDS = (b"X X X X_X".ljust(80) +
+                                b"Startdate 01-JAN-1970 X X X".ljust(80) +
+                                b"01.01.70" +
+                                b"00.00.00")
 
 
-def temp_anonymized_edf(file_path):
+def check_edf_suffix(file_path):
     type_ = Path(file_path).suffix
     if type_ != ".edf":
         raise ValueError(f"Attempting to anonymize non-edf file '{file_path} with suffix '{type_}'. "
                          "This feature is currently only available for EDF(+) (.edf) file types.")
-    logger.info(f"Anonymizing file at {file_path}.")
-    anon_file = NamedTemporaryFile(mode="w+b", suffix=file_path.suffix)
-    logger.info(f"-- Temp file name: {anon_file.name}")
-    with open(file_path, "rb") as in_f:
-        while True:
-            data = in_f.read(8096)
-            if not data:
-                break
-            anon_file.write(data)
+    return type_
+
+
+def random_hex_string(length=12):
+    return os.urandom((length + 1) // 2).hex()[:length]
+
+
+class AnonymizedEDFReader:
+    """
+    Read-only file-like object over an EDF file which returns the file contents with anonymized header fields.
+
+    The original file is not modified and no copy is written to disk: reads from the first 256 bytes (the fixed
+    part of the EDF header) are served from an in-memory, anonymized copy of the header and all later reads are
+    delegated to the original file.
+
+    The 'len' attribute gives the number of bytes left to read as expected by requests_toolbelt's MultipartEncoder.
+    """
+    HEADER_SIZE = 256
+
+    def __init__(self, file_path):
+        check_edf_suffix(file_path)
+        logger.info("Anonymizing file at %s (on read).", file_path)
+        # Neutral name, the original file name may identify the patient (e.g., if used as an upload file name)
+        self.name = "anonymized.edf"
+        self._file = open(file_path, "rb")
+        header = bytearray(self._file.read(self.HEADER_SIZE))
+        header[8:8 + len(ANONYMIZED_EDF_HEADER_FIELDS)] = ANONYMIZED_EDF_HEADER_FIELDS
+        self._header = bytes(header)
+        self._size = max(os.fstat(self._file.fileno()).st_size, len(self._header))
+        self._position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    @property
+    def len(self):
+        return self._size - self._position
+
+    def close(self):
+        self._file.close()
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        if self._position >= len(self._header):
+            self._file.seek(self._position)
+        return self._position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        data = b""
+        if self._position < len(self._header):
+            data = self._header[self._position:self._position + size]
+            self.seek(self._position + len(data))
+            size -= len(data)
+        if size > 0:
+            data += self._file.read(size)
+            self._position = self._file.tell()
+        return data
+
+
+def temp_anonymized_edf(file_path):
+    """
+    Return a temporary file opened at offset 0 with the contents of the EDF file at 'file_path' with anonymized
+    header fields. The file is removed when closed. Use AnonymizedEDFReader to avoid writing a copy.
+    """
+    type_ = check_edf_suffix(file_path)
+    logger.info("Anonymizing file at %s.", file_path)
+    anon_file = NamedTemporaryFile(mode="w+b", suffix=type_)
+    logger.info("-- Temp file name: %s", anon_file.name)
+    # Copy by path so the copy is done in-kernel where possible (sendfile on Linux, fcopyfile on macOS)
+    shutil.copyfile(file_path, anon_file.name)
     anon_file.seek(8)
     logger.info("-- Anonymizing patient ID, sex, birthdate and name fields.")
-    anon_file.write("X X X X_X".ljust(80).encode("ascii"))
     logger.info("-- Anonymizing start date and admin-, tech and equipment codes.")
-    anon_file.write("Startdate 01-JAN-1970 X X X".ljust(80).encode("ascii"))
-    anon_file.write("01.01.70".encode("ascii"))
-    anon_file.write("00.00.00".encode("ascii"))
+    anon_file.write(ANONYMIZED_EDF_HEADER_FIELDS)
     anon_file.seek(0)
     return anon_file